@@ -20,20 +20,26 @@ PIPELINE:
 
 from __future__ import annotations
 
-import json
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Optional, Tuple, Dict
+from typing import List, Optional, Tuple
 
 import firebase_admin
 import numpy as np
+import orjson
 import pandas as pd
 import requests
 from firebase_admin import credentials, firestore, storage as fb_storage
+from requests.adapters import HTTPAdapter
 import geopandas as gpd
+import shapely
+from numba import njit
+from pyproj import Transformer
 from shapely.geometry import LineString, mapping
-from math import radians, sin, cos, asin, sqrt
+from shapely.strtree import STRtree
 
 # ==============================
 # --- CONFIGURABLE CONSTANTS ---
@@ -46,6 +52,7 @@ TEST_SINGLE_DOC_ID = None  # if u only wanna use one document to test, eg. inser
 FIRESTORE_VIBE_COLLECTION = "vibration_logs"
 FIRESTORE_STATUS_COLLECTION = "system"
 FIRESTORE_STATUS_DOC = "iri_status"
+FIRESTORE_FETCH_WORKERS = 16  # sessions loaded in parallel (I/O bound)
 
 # Storage
 STORAGE_BUCKET_NAME = "aiot-road-app.firebasestorage.app"
@@ -58,11 +65,14 @@ MAPBOX_ACCESS_TOKEN = os.environ.get(
 )
 MAPBOX_MATCH_URL = "https://api.mapbox.com/matching/v5/mapbox/driving"
 MAPBOX_MAX_POINTS = 90
+MAPBOX_MATCH_WORKERS = 8  # chunks matched concurrently
 
 # Algorithm Config
 IRI_WINDOW_SIZE_M = 100.0  
 MIN_WINDOW_DIST_M = 20.0   
 ROLLING_HP_SEC = 1.0
+GPS_DECIMATE_M = 2.0       # keep one GPS fix per ~2m of travel for distance + map matching
+EARTH_RADIUS_M = 6371000.0
 
 # --- Gap & Speed Config ---
 MAX_GAP_SECONDS = 15.0     # Split track if gap > 15s
@@ -87,68 +97,100 @@ firebase_admin.initialize_app(cred, {"storageBucket": STORAGE_BUCKET_NAME})
 db = firestore.client()
 bucket = fb_storage.bucket()
 
+# =======================
+# --- HTTP SETUP ---
+# =======================
+
+# Shared pooled session so concurrent Mapbox requests reuse connections
+mapbox_session = requests.Session()
+mapbox_session.mount("https://", HTTPAdapter(pool_connections=MAPBOX_MATCH_WORKERS, pool_maxsize=MAPBOX_MATCH_WORKERS))
+
+# =======================
+# --- PROJECTIONS ---
+# =======================
+
+# Built once; GeoSeries.to_crs would rebuild a transformer on every call
+_T_4326_3857 = Transformer.from_crs(4326, 3857, always_xy=True)
+_T_3857_4326 = Transformer.from_crs(3857, 4326, always_xy=True)
+
 # =======================
 # --- MATH HELPERS ---
 # =======================
 
-def _haversine_m(lat1, lon1, lat2, lon2) -> float:
-    R = 6371000.0
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = (sin(dlat / 2.0) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2.0) ** 2)
-    return 2.0 * R * asin(sqrt(a))
+def _haversine_seg_m(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    # Vectorised haversine between consecutive points (length n-1)
+    R = EARTH_RADIUS_M
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lat1 = np.radians(lat[:-1])
+    lat2 = np.radians(lat[1:])
+    dlat = lat2 - lat1
+    dlon = np.radians(lon[1:] - lon[:-1])
+    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2
+    return 2.0 * R * np.arcsin(np.sqrt(a))
+
+def _decimate_gps(lat: np.ndarray, lon: np.ndarray, step_m: float) -> np.ndarray:
+    # Indices of the fixes where a coarse equirectangular distance crosses each step_m mark
+    dy = np.diff(lat) * 111e3
+    dx = np.diff(lon) * 111e3 * np.cos(np.radians(lat[1:]))
+    c = np.concatenate(([0.0], np.cumsum(np.hypot(dx, dy))))
+    keep = np.concatenate(([True], np.diff(np.floor(c / step_m)) > 0))
+    keep[-1] = True
+    return np.flatnonzero(keep)
 
 def _cumdist_raw(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
-    n = len(lat)
-    cd = np.zeros(n, dtype=float)
-    for i in range(1, n):
-        cd[i] = cd[i - 1] + _haversine_m(lat[i - 1], lon[i - 1], lat[i], lon[i])
-    return cd
-
-def _cumtrapz_np(y: np.ndarray, x: np.ndarray) -> np.ndarray:
-    y = np.asarray(y, dtype=float)
-    x = np.asarray(x, dtype=float)
-    dx = np.diff(x)
-    dx[~np.isfinite(dx)] = 0.0
-    dx[dx <= 0] = 1e-6
-    area = 0.5 * (y[1:] + y[:-1]) * dx
-    return np.concatenate(([0.0], np.cumsum(area)))
-
-def _iri_window(t: np.ndarray, a: np.ndarray, s_m: float) -> Optional[float]:
-    # Check Speed: If avg speed is too low, accelerometer drift dominates -> Fake Red IRI.
-    duration = t[-1] - t[0]
-    if duration <= 0: return None
-    
-    avg_speed = s_m / duration
-    if avg_speed < MIN_SPEED_MPS:
-        return None # Skip this window (too slow)
+    if len(lat) == 0: return np.zeros(0, dtype=float)
+    return np.concatenate(([0.0], np.cumsum(_haversine_seg_m(lat, lon))))
 
-    if s_m < MIN_WINDOW_DIST_M or len(t) < 2:
-        return None
-        
-    v = _cumtrapz_np(a, t)
-    disp_equiv = np.trapezoid(np.abs(v), t)
-    return float(disp_equiv / (s_m / 1000.0))
-
-def _window_indices_by_distance(dist_arr: np.ndarray, step_m: float) -> List[Tuple[int, int]]:
-    n = len(dist_arr)
-    if n < 2: return []
-    
-    windows = []
+@njit(cache=True)
+def _iri_window_nb(t: np.ndarray, a: np.ndarray, i0: int, i1: int, s_m: float,
+                   min_w: float, min_speed: float) -> float:
+    # Check Speed: If avg speed is too low, accelerometer drift dominates -> Fake Red IRI.
+    duration = t[i1] - t[i0]
+    if duration <= 0: return np.nan
+    if s_m / duration < min_speed: return np.nan # Skip this window (too slow)
+    if s_m < min_w: return np.nan
+
+    # Trapezoid-integrate accel -> velocity and |velocity| -> displacement in one pass
+    v = 0.0
+    disp_equiv = 0.0
+    for k in range(i0 + 1, i1 + 1):
+        dt_raw = t[k] - t[k - 1]
+        dt = dt_raw
+        if not np.isfinite(dt): dt = 0.0
+        elif dt <= 0: dt = 1e-6
+        v_next = v + 0.5 * (a[k] + a[k - 1]) * dt
+        disp_equiv += 0.5 * (abs(v) + abs(v_next)) * dt_raw
+        v = v_next
+    return disp_equiv / (s_m / 1000.0)
+
+@njit(cache=True)
+def _iri_segments(t: np.ndarray, a: np.ndarray, cd: np.ndarray, step_m: float,
+                  min_w: float, min_speed: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Walks the cumulative distance once, closing a window every step_m and
+    # computing its IRI on the fly. Returns (i0, i1, iri) for valid windows only.
+    n = cd.shape[0]
+    out_i0 = np.empty(n, dtype=np.int64)
+    out_i1 = np.empty(n, dtype=np.int64)
+    out_iri = np.empty(n, dtype=np.float64)
+    m = 0
     start_idx = 0
-    start_dist = dist_arr[0]
 
     for i in range(1, n):
-        if dist_arr[i] - start_dist >= step_m:
-            windows.append((start_idx, i))
+        close = cd[i] - cd[start_idx] >= step_m
+        # Trailing partial window, kept if long enough
+        if not close and i == n - 1 and cd[i] - cd[start_idx] >= min_w:
+            close = True
+        if close:
+            iri = _iri_window_nb(t, a, start_idx, i, max(0.0, cd[i] - cd[start_idx]), min_w, min_speed)
+            if not np.isnan(iri):
+                out_i0[m] = start_idx
+                out_i1[m] = i
+                out_iri[m] = iri
+                m += 1
             start_idx = i
-            start_dist = dist_arr[i]
 
-    if start_idx < n - 1:
-        if dist_arr[n - 1] - start_dist >= MIN_WINDOW_DIST_M:
-            windows.append((start_idx, n - 1))
-
-    return windows
+    return out_i0[:m], out_i1[:m], out_iri[:m]
 
 # --- SIGNAL PROCESSING ---
 def _estimate_fs(t: np.ndarray) -> float:
@@ -156,70 +198,122 @@ def _estimate_fs(t: np.ndarray) -> float:
     dt = dt[np.isfinite(dt) & (dt > 0)]
     return float(1.0 / np.median(dt)) if dt.size > 0 else 100.0
 
-def _rolling_median(y: np.ndarray, win: int) -> np.ndarray:
-    return pd.Series(y).rolling(win, center=True, min_periods=1).median().to_numpy() if win > 1 else y
-
-def _moving_average(y: np.ndarray, win: int) -> np.ndarray:
-    if win <= 1: return y
-    kernel = np.ones(win, dtype=float) / float(win)
-    return np.convolve(y, kernel, mode="same")
-
-def _hampel(y: np.ndarray, win: int, k: float = 3.0) -> np.ndarray:
-    if win <= 1: return y.copy()
-    s = pd.Series(y)
-    med = s.rolling(win, center=True, min_periods=1).median()
-    diff = np.abs(s - med)
-    mad = 1.4826 * diff.rolling(win, center=True, min_periods=1).median()
-    mask = diff > (k * mad.replace(0, np.nan))
-    out = y.copy()
-    out[mask] = med[mask]
-    return out
+# Rolling kernels are centered with min_periods=1 (pandas alignment) and keep the
+# raw window values in a ring buffer, so src and dst may be the same array.
+@njit(cache=True, fastmath=True)
+def _rolling_mean_nb(src: np.ndarray, win: int, dst: np.ndarray) -> None:
+    n = src.shape[0]
+    lo = win // 2
+    hi = (win - 1) // 2
+    ring = np.empty(win, dtype=np.float64)
+    total = 0.0
+    cnt = 0
+    for i in range(-hi, n):
+        rem = i - lo - 1
+        if rem >= 0:
+            total -= ring[rem % win]
+            cnt -= 1
+        add = i + hi
+        if add < n:
+            ring[add % win] = src[add]
+            total += src[add]
+            cnt += 1
+        if i >= 0:
+            dst[i] = total / cnt
+
+@njit(cache=True, fastmath=True)
+def _rolling_median_nb(src: np.ndarray, win: int, dst: np.ndarray) -> None:
+    n = src.shape[0]
+    lo = win // 2
+    hi = (win - 1) // 2
+    ring = np.empty(win, dtype=np.float64)
+    buf = np.empty(win, dtype=np.float64) # sorted window values
+    cnt = 0
+    for i in range(-hi, n):
+        rem = i - lo - 1
+        if rem >= 0:
+            pos = np.searchsorted(buf[:cnt], ring[rem % win])
+            for j in range(pos, cnt - 1):
+                buf[j] = buf[j + 1]
+            cnt -= 1
+        add = i + hi
+        if add < n:
+            v = src[add]
+            ring[add % win] = v
+            pos = np.searchsorted(buf[:cnt], v)
+            for j in range(cnt, pos, -1):
+                buf[j] = buf[j - 1]
+            buf[pos] = v
+            cnt += 1
+        if i >= 0:
+            mid = cnt // 2
+            dst[i] = buf[mid] if cnt % 2 == 1 else 0.5 * (buf[mid - 1] + buf[mid])
+
+@njit(cache=True, fastmath=True)
+def _denoise_kernel(a: np.ndarray, win_hp: int, win_hampel: int, k: float,
+                    win_med: int, win_mean: int) -> np.ndarray:
+    # HP + Hampel + median + moving average over three n-length buffers
+    n = a.shape[0]
+    y = np.empty(n, dtype=np.float64)
+    med = np.empty(n, dtype=np.float64)
+    mad = np.empty(n, dtype=np.float64)
+
+    # High Pass
+    _rolling_mean_nb(a, win_hp, y)
+    for i in range(n):
+        y[i] = a[i] - y[i]
+
+    # Hampel: MAD is the rolling median of each sample's own |y - med|
+    _rolling_median_nb(y, win_hampel, med)
+    for i in range(n):
+        mad[i] = abs(y[i] - med[i])
+    _rolling_median_nb(mad, win_hampel, mad)
+    for i in range(n):
+        m = 1.4826 * mad[i]
+        if m > 0 and abs(y[i] - med[i]) > k * m:
+            y[i] = med[i]
+
+    _rolling_median_nb(y, win_med, y)
+    _rolling_mean_nb(y, win_mean, y)
+    return y
 
 def _denoise_accel(a: np.ndarray, t: np.ndarray) -> np.ndarray:
     if len(a) < 2: return a
     dt_arr = np.diff(t)
     dt_arr = dt_arr[np.isfinite(dt_arr) & (dt_arr > 0)]
     dt = float(np.median(dt_arr)) if dt_arr.size > 0 else 0.01
-    
-    # High Pass
     win_hp = max(3, int(round(ROLLING_HP_SEC / max(dt, 1e-6))))
-    baseline = pd.Series(a).rolling(win_hp, center=True, min_periods=1).mean().to_numpy()
-    hp = a - baseline
 
     fs = _estimate_fs(t)
     def _to_samples(sec: float) -> int:
         n = max(3, int(round(sec * fs)))
         return n if (n % 2 == 1) else n + 1
 
-    y = _hampel(hp, _to_samples(HAMPEL_SEC), HAMPEL_K)
-    y = _rolling_median(y, _to_samples(MEDIAN_SEC))
-    y = _moving_average(y, _to_samples(MEAN_SEC))
-    return y
+    return _denoise_kernel(
+        np.ascontiguousarray(a, dtype=np.float64), win_hp,
+        _to_samples(HAMPEL_SEC), HAMPEL_K, _to_samples(MEDIAN_SEC), _to_samples(MEAN_SEC),
+    )
 
 # --- GEOMETRY ---
-def _cut_linestring_by_m(ls_merc: LineString, d_m: float) -> Tuple[LineString, LineString]:
-    if d_m <= 0.0: return LineString([]), LineString(list(ls_merc.coords))
-    if d_m >= ls_merc.length: return LineString(list(ls_merc.coords)), LineString([])
-    
-    coords = list(ls_merc.coords)
-    acc = 0.0
-    for i in range(1, len(coords)):
-        segment = LineString([coords[i - 1], coords[i]])
-        seg_len = segment.length
-        if acc + seg_len >= d_m:
-            t = (d_m - acc) / seg_len
-            x0, y0 = coords[i - 1]
-            x1, y1 = coords[i]
-            xm, ym = x0 + t*(x1-x0), y0 + t*(y1-y0)
-            return LineString(coords[:i] + [(xm, ym)]), LineString([(xm, ym)] + coords[i:])
-        acc += seg_len
-    return LineString(list(ls_merc.coords)), LineString([])
-
-def _substring_by_m(ls_merc: LineString, d0: float, d1: float) -> LineString:
+def _substring_fast(xy: np.ndarray, cum: np.ndarray, d0: float, d1: float) -> LineString:
+    # Substring between distances d0..d1 using precomputed vertex cumulative lengths:
+    # bisect for the inner vertices and interpolate the two end points.
+    d0 = max(d0, 0.0)
+    d1 = min(d1, cum[-1])
     if d1 <= d0: return LineString([])
-    _, right = _cut_linestring_by_m(ls_merc, d0)
-    sub, _ = _cut_linestring_by_m(right, d1 - d0)
-    return sub
+    i0 = np.searchsorted(cum, d0, side="right")
+    i1 = np.searchsorted(cum, d1, side="left")
+    ends_x = np.interp((d0, d1), cum, xy[:, 0])
+    ends_y = np.interp((d0, d1), cum, xy[:, 1])
+    return LineString(np.vstack((
+        [[ends_x[0], ends_y[0]]],
+        xy[i0:i1],
+        [[ends_x[1], ends_y[1]]],
+    )))
+
+def _reproject(geoms, transformer: Transformer):
+    # Vectorised coordinate transform of one geometry or an array of geometries
+    return shapely.transform(geoms, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
 
 def iri_to_color(v: float) -> str:
     if v < 2.5: return "#22c55e"
@@ -242,9 +336,13 @@ def set_last_processed_ts(ts: float) -> None:
         {"lastProcessedTimestamp": float(ts), "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True
     )
 
-def load_session_samples(session_id: str) -> List[Dict]:
+def load_session_samples(session_id: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (t, lat, lon, y) column arrays for one session, in stored order.
+    Sorting is left to fetch_vibration_logs, which sorts all sessions at once.
+    """
     session_ref = db.collection(FIRESTORE_VIBE_COLLECTION).document(session_id)
-    samples = []
+    ts, lats, lons, ys = [], [], [], []
     for bdoc in session_ref.collection("data").stream():
         batch = bdoc.to_dict() or {}
         for row in batch.get("data", []):
@@ -252,24 +350,38 @@ def load_session_samples(session_id: str) -> List[Dict]:
                 lat = float(row.get("latitude"))
                 lon = float(row.get("longitude"))
                 y = float(row.get("y"))
-                ts = float(row.get("timestamp"))
-                if ts > 1e12: ts /= 1000.0 # ms to sec
-                samples.append({"t": ts, "lat": lat, "lon": lon, "y": y})
+                t = float(row.get("timestamp"))
+                if t > 1e12: t /= 1000.0 # ms to sec
             except: continue
-    samples.sort(key=lambda r: r["t"])
-    return samples
+            ts.append(t)
+            lats.append(lat)
+            lons.append(lon)
+            ys.append(y)
+    # Accel is only ever a few g, float32 is plenty; time (epoch) and lat/lon stay float64
+    return np.array(ts, dtype=float), np.array(lats, dtype=float), np.array(lons, dtype=float), np.array(ys, dtype=np.float32)
 
 def fetch_vibration_logs(last_ts: Optional[float]) -> pd.DataFrame:
-    rows = []
     ids = [TEST_SINGLE_DOC_ID] if TEST_SINGLE_DOC_ID else [d.id for d in db.collection(FIRESTORE_VIBE_COLLECTION).stream()]
     
-    for sid in ids:
-        samples = load_session_samples(sid)
-        for s in samples:
-            if last_ts and s["t"] <= last_ts: continue
-            rows.append({"timestamp_sec": s["t"], "latitude": s["lat"], "longitude": s["lon"], "accel_y": s["y"]})
-            
-    return pd.DataFrame(rows).sort_values("timestamp_sec").reset_index(drop=True) if rows else pd.DataFrame()
+    # Each session is a separate round-trip; fetch them concurrently (results keep id order)
+    with ThreadPoolExecutor(max_workers=FIRESTORE_FETCH_WORKERS) as ex:
+        sessions = list(ex.map(load_session_samples, ids))
+    if not sessions: return pd.DataFrame()
+
+    t, lat, lon, y = (np.concatenate(cols) for cols in zip(*sessions))
+    if last_ts:
+        keep = t > last_ts
+        t, lat, lon, y = t[keep], lat[keep], lon[keep], y[keep]
+    if t.size == 0: return pd.DataFrame()
+
+    # Single global sort across sessions
+    order = np.argsort(t, kind="stable")
+    return pd.DataFrame({
+        "timestamp_sec": t[order],
+        "latitude": lat[order],
+        "longitude": lon[order],
+        "accel_y": y[order],
+    })
 
 # ==============================
 # --- CORE LOGIC: SPLIT & PROCESS ---
@@ -284,32 +396,19 @@ def split_into_tracks(df: pd.DataFrame) -> List[pd.DataFrame]:
     """
     if df.empty: return []
     
+    t = df["timestamp_sec"].to_numpy()
+    lat = df["latitude"].to_numpy()
+    lon = df["longitude"].to_numpy()
+
+    # Detect Gaps (vectorised over consecutive samples)
+    gap_mask = (np.diff(t) > MAX_GAP_SECONDS) | (_haversine_seg_m(lat, lon) > MAX_GAP_METERS)
+    split_points = np.flatnonzero(gap_mask) + 1
+
     tracks = []
-    current_idx_start = 0
-    n = len(df)
-    
-    t = df["timestamp_sec"].values
-    lat = df["latitude"].values
-    lon = df["longitude"].values
-    
-    for i in range(1, n):
-        dt = t[i] - t[i-1]
-        dist = _haversine_m(lat[i-1], lon[i-1], lat[i], lon[i])
-        
-        # Detect Gap
-        if dt > MAX_GAP_SECONDS or dist > MAX_GAP_METERS:
-            # Save previous track
-            track = df.iloc[current_idx_start:i].copy().reset_index(drop=True)
-            if len(track) > 10: # Only keep valid chunks
-                tracks.append(track)
-            current_idx_start = i
-            
-    # Last track
-    if current_idx_start < n:
-        track = df.iloc[current_idx_start:].copy().reset_index(drop=True)
-        if len(track) > 10:
-            tracks.append(track)
-            
+    for g in np.split(np.arange(len(df)), split_points):
+        if len(g) > 10: # Only keep valid chunks
+            tracks.append(df.iloc[g[0]:g[-1] + 1].reset_index(drop=True))
+
     return tracks
 
 def process_single_track(df_track: pd.DataFrame) -> List[Tuple[LineString, float]]:
@@ -325,49 +424,54 @@ def process_single_track(df_track: pd.DataFrame) -> List[Tuple[LineString, float
     t_rel = t - t[0]
     a_clean = _denoise_accel(a_y, t_rel)
     
-    # 2. Cumulative Distance
-    cd_raw = _cumdist_raw(lat, lon)
+    # 2. Cumulative Distance on decimated GPS, interpolated back to every sample
+    # (sub-meter hops between high-rate fixes are mostly GPS noise)
+    keep_idx = _decimate_gps(lat, lon, GPS_DECIMATE_M)
+    cd_raw = np.interp(np.arange(len(lat)), keep_idx, _cumdist_raw(lat[keep_idx], lon[keep_idx]))
     tot_raw_m = cd_raw[-1] if len(cd_raw) > 0 else 0
     if tot_raw_m < 50: return [] # Ignore tiny tracks
 
     # 3. Mapbox Snap
-    s_lat, s_lon = snap_track_mapbox(lat[::2], lon[::2]) # Subsample 2 for speed
+    s_lat, s_lon = snap_track_mapbox(lat[keep_idx], lon[keep_idx])
     if len(s_lat) < 2: return []
     
-    snapped_ls = LineString(list(zip(s_lon, s_lat)))
-    ls_merc = gpd.GeoSeries([snapped_ls], crs="EPSG:4326").to_crs(epsg=3857).iloc[0]
-    snapped_len_m = ls_merc.length
-
-    # 4. Window by Distance (100m)
-    windows = _window_indices_by_distance(cd_raw, IRI_WINDOW_SIZE_M)
-    segments = []
+    xs, ys = _T_4326_3857.transform(s_lon, s_lat)
+    xy_merc = np.column_stack([xs, ys])
+    cum_merc = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(xs), np.diff(ys)))))
+    snapped_len_m = cum_merc[-1]
+
+    # 4. Window by Distance (100m) + IRI (includes Speed Check inside)
+    win_i0, win_i1, win_iri = _iri_segments(
+        t_rel, a_clean, cd_raw, IRI_WINDOW_SIZE_M, MIN_WINDOW_DIST_M, MIN_SPEED_MPS
+    )
+    subs_merc, iri_vals = [], []
 
-    for (i0, i1) in windows:
+    for i0, i1, iri_val in zip(win_i0, win_i1, win_iri):
         s0, s1 = cd_raw[i0], cd_raw[i1]
-        dist = max(0.0, s1 - s0)
-        
-        # Calculate IRI (includes Speed Check inside)
-        iri_val = _iri_window(t_rel[i0:i1+1], a_clean[i0:i1+1], dist)
-        if iri_val is None: continue # Skipped (too slow or too short)
+        iri_val = float(iri_val)
 
         # Map to snapped line
         d0_snap = snapped_len_m * (s0 / max(tot_raw_m, 1e-6))
         d1_snap = snapped_len_m * (s1 / max(tot_raw_m, 1e-6))
         
-        sub_merc = _substring_by_m(ls_merc, d0_snap, d1_snap)
+        sub_merc = _substring_fast(xy_merc, cum_merc, d0_snap, d1_snap)
         if not sub_merc.is_empty and len(sub_merc.coords) >= 2:
-            sub_wgs = gpd.GeoSeries([sub_merc], crs="EPSG:3857").to_crs(epsg=4326).iloc[0]
-            segments.append((sub_wgs, iri_val))
-            
-    return segments
+            subs_merc.append(sub_merc)
+            iri_vals.append(iri_val)
+
+    if not subs_merc: return []
+
+    # Reproject all segments back to WGS84 in one go
+    subs_wgs = _reproject(subs_merc, _T_3857_4326)
+    return list(zip(subs_wgs, iri_vals))
 
 # --- MAPBOX & GEOJSON UTILS ---
 def _match_chunk_mapbox(lat_chunk, lon_chunk):
     coords = ";".join(f"{lo:.6f},{la:.6f}" for la, lo in zip(lat_chunk, lon_chunk))
     try:
-        r = requests.get(f"{MAPBOX_MATCH_URL}/{coords}", 
-                         params={"access_token": MAPBOX_ACCESS_TOKEN, "geometries": "geojson", "tidy": "true"}, 
-                         timeout=15)
+        r = mapbox_session.get(f"{MAPBOX_MATCH_URL}/{coords}", 
+                               params={"access_token": MAPBOX_ACCESS_TOKEN, "geometries": "geojson", "tidy": "true"}, 
+                               timeout=15)
         data = r.json()
         if data.get("code") == "Ok":
             coords = data["matchings"][0]["geometry"]["coordinates"]
@@ -376,40 +480,54 @@ def _match_chunk_mapbox(lat_chunk, lon_chunk):
     return lat_chunk, lon_chunk
 
 def snap_track_mapbox(lat, lon):
-    s_lat_all, s_lon_all = [], []
+    # Chunk ranges overlap by one point so consecutive matches join up
+    ranges = []
     i = 0
     n = len(lat)
     while i < n - 1:
         j = min(i + MAPBOX_MAX_POINTS, n)
-        sl, slon = _match_chunk_mapbox(lat[i:j], lon[i:j])
-        if i == 0:
+        ranges.append((i, j))
+        i = j - 1
+
+    with ThreadPoolExecutor(max_workers=MAPBOX_MATCH_WORKERS) as ex:
+        matched = list(ex.map(lambda r: _match_chunk_mapbox(lat[r[0]:r[1]], lon[r[0]:r[1]]), ranges))
+
+    s_lat_all, s_lon_all = [], []
+    for k, (sl, slon) in enumerate(matched):
+        if k == 0:
             s_lat_all.extend(sl)
             s_lon_all.extend(slon)
         else:
             s_lat_all.extend(sl[1:]) # overlap fix
             s_lon_all.extend(slon[1:])
-        i = j - 1
     return np.array(s_lat_all), np.array(s_lon_all)
 
+def segment_cell_keys(geoms_wgs, grid_m: float = 50.0) -> np.ndarray:
+    """
+    Bulk version of segment_cell_key: one (cx, cy) row per segment.
+    Projects all segments with the cached transformer and takes their midpoints in one go.
+    """
+    geoms_wgs = np.asarray(geoms_wgs, dtype=object)
+    if (shapely.is_missing(geoms_wgs) | shapely.is_empty(geoms_wgs)).any():
+        raise ValueError("segment_cell_keys: empty or missing segment geometry")
+    geoms_merc = _reproject(geoms_wgs, _T_4326_3857)
+    mids = shapely.line_interpolate_point(geoms_merc, 0.5, normalized=True)
+    mids_xy = np.column_stack([shapely.get_x(mids), shapely.get_y(mids)])
+    return np.floor_divide(mids_xy, grid_m).astype(np.int64)
+
 def segment_cell_key(geom_wgs: LineString, grid_m: float = 50.0) -> Tuple[int, int]:
     """
     Converts a road segment into a stable spatial cell key.
     Roads re-driven later will fall into the same cell.
     """
-    geom_merc = (
-        gpd.GeoSeries([geom_wgs], crs="EPSG:4326")
-        .to_crs(epsg=3857)
-        .iloc[0]
-    )
-
-    mid = geom_merc.interpolate(0.5, normalized=True)
-    return (int(mid.x // grid_m), int(mid.y // grid_m))
+    cx, cy = segment_cell_keys([geom_wgs], grid_m)[0]
+    return (int(cx), int(cy))
 
 def deduplicate_segments(
     new_segments: List[Tuple[LineString, float]],
-    old_features: List[Dict],
+    old_gdf: gpd.GeoDataFrame,
     buffer_m: float = DEDUP_BUFFER_M,
-) -> List[Dict]:
+) -> gpd.GeoDataFrame:
     """
     Replace old segments ONLY where new segments overlap them.
     Always keep all new segments.
@@ -432,79 +550,79 @@ def deduplicate_segments(
 
     if not new_records:
         # No new data, keep all old data
-        return old_features
+        return old_gdf
 
-    new_gdf = gpd.GeoDataFrame(
-        new_records,
-        crs="EPSG:4326",
-    ).to_crs(epsg=3857)
+    new_gdf = gpd.GeoDataFrame(new_records, geometry="geometry", crs="EPSG:4326")
 
-    # --- Buffer all new segments ---
-    new_union_buffer = new_gdf.geometry.buffer(buffer_m).unary_union
+    new_geoms_3857 = _reproject(new_gdf.geometry.to_numpy(), _T_4326_3857)
+
+    # --- Buffer all new segments + spatial index ---
+    new_buffer_tree = STRtree(shapely.buffer(new_geoms_3857, buffer_m))
 
     # --- Filter old features ---
-    kept_old_features = []
-    for feat in old_features:
-        try:
-            old_geom = LineString(feat["geometry"]["coordinates"])
-            old_geom_3857 = gpd.GeoSeries(
-                [old_geom], crs="EPSG:4326"
-            ).to_crs(epsg=3857).iloc[0]
-
-            # Keep old ONLY if it does not overlap any new buffer
-            if not old_geom_3857.intersects(new_union_buffer):
-                kept_old_features.append(feat)
-
-        except Exception:
-            # Fail-safe: keep malformed old features
-            kept_old_features.append(feat)
-
-    # --- Convert new segments back to GeoJSON ---
-    new_gdf_wgs = new_gdf.to_crs(epsg=4326)
-
-    new_features = []
-    for _, row in new_gdf_wgs.iterrows():
-        new_features.append(
-            {
-                "type": "Feature",
-                "geometry": mapping(row.geometry),
-                "properties": {
-                    "iri": safe_float(row["iri"]),
-                    "color": row["color"],
-                },
-            }
-        )
+    old_geoms = old_gdf.geometry.to_numpy()
+    keep = np.ones(len(old_gdf), dtype=bool)
+
+    # Fail-safe: keep old features with missing/empty geometry
+    valid = np.flatnonzero(~(shapely.is_missing(old_geoms) | shapely.is_empty(old_geoms)))
+    if valid.size:
+        old_geoms_3857 = _reproject(old_geoms[valid], _T_4326_3857)
 
-    return kept_old_features + new_features
+        # Keep old ONLY if it does not overlap any new buffer
+        hits, _ = new_buffer_tree.query(old_geoms_3857, predicate="intersects")
+        keep[valid[hits]] = False
 
+    return pd.concat([old_gdf[keep], new_gdf], ignore_index=True)
 
 
-def save_and_upload(new_segments, old_features):
-    print(f"[INFO] Deduplicating {len(new_segments)} new segments against {len(old_features)} old ones...")
 
-    merged_features = deduplicate_segments(
+def save_and_upload(new_segments, old_gdf):
+    print(f"[INFO] Deduplicating {len(new_segments)} new segments against {len(old_gdf)} old ones...")
+
+    merged_gdf = deduplicate_segments(
         new_segments=new_segments,
-        old_features=old_features,
+        old_gdf=old_gdf,
     )
 
-    fc = {"type": "FeatureCollection", "features": merged_features}
+    # Quantize output: 1e-6 deg (~0.1m) coordinates, 2-decimal IRI
+    geoms = shapely.transform(merged_gdf.geometry.to_numpy(), lambda xy: np.round(xy, 6))
+    iris = np.round(merged_gdf["iri"].to_numpy(dtype=float), 2)
+
+    fc = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": mapping(geom) if geom is not None else None,
+                "properties": {"iri": iri, "color": color},
+            }
+            for geom, iri, color in zip(geoms, iris, merged_gdf["color"])
+        ],
+    }
+    blob_bytes = orjson.dumps(fc, option=orjson.OPT_SERIALIZE_NUMPY)
 
     out_path = BASE_DIR / "iri_latest.geojson"
-    with out_path.open("w", encoding="utf-8") as f:
-        json.dump(fc, f)
+    out_path.write_bytes(blob_bytes)
 
-    bucket.blob(STORAGE_BLOB_PATH).upload_from_filename(
-        str(out_path), content_type="application/geo+json"
+    bucket.blob(STORAGE_BLOB_PATH).upload_from_string(
+        blob_bytes, content_type="application/geo+json"
     )
 
-    print(f"[DONE] GeoJSON updated. Total segments now = {len(merged_features)}")
+    print(f"[DONE] GeoJSON updated. Total segments now = {len(merged_gdf)}")
+
 
+def _empty_features() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(columns=["iri", "color", "geometry"], geometry="geometry", crs="EPSG:4326")
 
-def load_existing_features():
+def load_existing_features() -> gpd.GeoDataFrame:
     blob = bucket.blob(STORAGE_BLOB_PATH)
-    if not blob.exists(): return []
-    try: return json.loads(blob.download_as_text()).get("features", [])
-    except: return []
+    if not blob.exists(): return _empty_features()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_path = Path(tmp_dir) / "iri_existing.geojson"
+            blob.download_to_filename(str(local_path))
+            return gpd.read_file(local_path, engine="pyogrio")
+    except: return _empty_features()
 
 def safe_float(v, default=0.0):
     if v is None:
@@ -540,8 +658,8 @@ def main():
 
     if not all_segments: return print("No valid IRI segments.")
 
-    old_features = load_existing_features() if TEST_SINGLE_DOC_ID is None else []
-    save_and_upload(all_segments, old_features)
+    old_gdf = load_existing_features() if TEST_SINGLE_DOC_ID is None else _empty_features()
+    save_and_upload(all_segments, old_gdf)
 
     if TEST_SINGLE_DOC_ID is None:
         set_last_processed_ts(df_all["timestamp_sec"].max())